@@ -83,6 +83,43 @@ function renderReport(data) {
   reportEl.appendChild(content);
 }
 
+function renderPartialReport(text) {
+  reportEl.classList.remove("empty");
+  reportEl.textContent = text;
+}
+
+async function readReportStream(response) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = "";
+  let partial = "";
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+
+    buffered += decoder.decode(value, { stream: true });
+    const events = buffered.split("\n\n");
+    buffered = events.pop();
+
+    for (const event of events) {
+      if (!event.startsWith("data: ")) {
+        continue;
+      }
+      const data = JSON.parse(event.slice(6));
+      if (data.done) {
+        return data;
+      }
+      partial += data.chunk || "";
+      renderPartialReport(partial);
+    }
+  }
+
+  throw new Error("Analysis stream ended unexpectedly.");
+}
+
 async function submitAnalysis(event) {
   event.preventDefault();
   const payload = getPayload();
@@ -101,17 +138,22 @@ async function submitAnalysis(event) {
   printBtn.disabled = true;
 
   try {
-    const response = await fetch("/api/analyze", {
+    const response = await fetch("/api/analyze/stream", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify(payload),
     });
 
-    const data = await response.json();
     if (!response.ok) {
+      const data = await response.json();
       throw new Error(data.error || "Analysis failed.");
     }
 
+    const data = await readReportStream(response);
+    if (data.error) {
+      throw new Error(data.error);
+    }
+
     renderReport(data);
     setStatus("Clinical report generated.", "ok");
     printBtn.disabled = false;